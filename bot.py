@@ -1,19 +1,23 @@
 # bot.py - Главный файл бота
 import os
-import requests
+import json
+import time
+import aiohttp
 import logging
-from logging.handlers import RotatingFileHandler
+import queue
+from aiolimiter import AsyncLimiter
+from logging.handlers import RotatingFileHandler, QueueHandler, QueueListener
 from aiogram import Bot, Dispatcher, types, F
 from aiogram.filters import CommandStart, Command
 from aiogram.types import Message, InlineKeyboardMarkup, InlineKeyboardButton, LabeledPrice, PreCheckoutQuery
 from aiogram.enums import ParseMode
+from aiogram.exceptions import TelegramRetryAfter
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from dotenv import load_dotenv
 import asyncio
-from datetime import datetime, timedelta
-from utils import markdown_to_html, smart_split_message
-from database import Database
+from utils import markdown_to_html, smart_split_message, TTLCache
+from database import AsyncDatabase, Database
 
 load_dotenv()
 
@@ -59,24 +63,36 @@ def setup_logging():
     console_handler.setLevel(logging.INFO)
     console_handler.setFormatter(log_format)
     
-    # Добавляем хендлеры
-    logger.addHandler(file_handler)
-    logger.addHandler(error_handler)
-    logger.addHandler(console_handler)
+    # Запись в файлы и консоль выполняется в фоновом потоке QueueListener,
+    # event loop только кладет записи в очередь
+    log_queue = queue.Queue(-1)
+    logger.addHandler(QueueHandler(log_queue))
+    listener = QueueListener(
+        log_queue, file_handler, error_handler, console_handler,
+        respect_handler_level=True
+    )
     
-    # Отключаем избыточное логирование от aiogram
+    # Отключаем избыточное логирование от aiogram и сетевых библиотек
     logging.getLogger('aiogram').setLevel(logging.WARNING)
+    logging.getLogger('aiohttp').setLevel(logging.WARNING)
+    logging.getLogger('httpx').setLevel(logging.WARNING)
+    logging.getLogger('asyncio').setLevel(logging.WARNING)
     
-    return logger
+    return logger, listener
 
 # Инициализируем логирование
-logger = setup_logging()
+logger, log_listener = setup_logging()
+log_listener.start()
 
 # Константа для установки лимита
 COOLDOWN_SECONDS = 7 
 MAX_MESSAGE_LENGTH = 4096 
-FREE_DAILY_LIMIT = os.getenv("FREE_DAILY_LIMIT")
-PREMIUM_DAILY_LIMIT = os.getenv("PREMIUM_DAILY_LIMIT")
+TYPING_INTERVAL = 4  # Telegram показывает "печатает" ~5 секунд
+STREAM_EDIT_INTERVAL = 1.0  # Telegram позволяет редактировать сообщение ~раз в секунду
+STREAM_CURSOR = "▌"
+HISTORY_LIMIT = 20  # Сколько последних сообщений отправляем модели как контекст
+FREE_DAILY_LIMIT = int(os.getenv("FREE_DAILY_LIMIT", "10"))
+PREMIUM_DAILY_LIMIT = int(os.getenv("PREMIUM_DAILY_LIMIT", "110"))
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 OPENROUTER_API_KEY = os.getenv("OPENROUTER_API_KEY_GPT")
 ADMIN_IDS = list(map(int, os.getenv("ADMIN_IDS", "").split(",")))
@@ -84,29 +100,93 @@ ADMIN_IDS = list(map(int, os.getenv("ADMIN_IDS", "").split(",")))
 
 logger.info("="*50)
 logger.info("Инициализация бота...")
-logger.info(f"Telegram Token: {'✓' if TELEGRAM_TOKEN else '✗'}")
-logger.info(f"OpenRouter API Key: {'✓' if OPENROUTER_API_KEY else '✗'}")
-logger.info(f"Количество администраторов: {len(ADMIN_IDS)}")
+logger.info("Telegram Token: %s", '✓' if TELEGRAM_TOKEN else '✗')
+logger.info("OpenRouter API Key: %s", '✓' if OPENROUTER_API_KEY else '✗')
+logger.info("Количество администраторов: %s", len(ADMIN_IDS))
 
 bot = Bot(token=TELEGRAM_TOKEN)
 dp = Dispatcher()
-db = Database()
+db = AsyncDatabase(Database())
+# HTTP-сессия для OpenRouter, создается в main() и переиспользует соединения
+aio_session: aiohttp.ClientSession = None
 
 API_URL = "https://openrouter.ai/api/v1/chat/completions"
 MODEL = "google/gemini-2.5-flash-lite-preview-09-2025"
 
+# Неизменная часть каждого запроса к API
+_AUTH_HEADERS = {
+    "Authorization": f"Bearer {OPENROUTER_API_KEY}",
+    "Content-Type": "application/json",
+}
+_SYSTEM_MSG = {
+    "role": "system",
+    "content": "Ты дружелюбный ассистент. Используй Markdown для форматирования: **жирный**, *курсив*, `код`, ```блоки кода```."
+}
+
 # Цены за токены
 INPUT_TOKEN_PRICE = 0.10 / 1_000_000
 OUTPUT_TOKEN_PRICE = 0.40 / 1_000_000
 
-# Лимиты и цены подписок (в Telegram Stars)
-FREE_DAILY_LIMIT = 10
+# Цены подписок (в Telegram Stars)
 SUBSCRIPTION_PRICES = {
     "week": {"price": 25, "days": 7, "title": "Неделя"},
     "month": {"price": 50, "days": 30, "title": "Месяц"},
     "year": {"price": 75, "days": 60, "title": "2 Месяца"}
 }
 
+# Клавиатуры не меняются, поэтому собираем их один раз
+_SUBSCRIPTION_KB = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(
+        text=f"⭐️ {SUBSCRIPTION_PRICES['week']['title']} - {SUBSCRIPTION_PRICES['week']['price']} Stars",
+        callback_data="subscribe_week"
+    )],
+    [InlineKeyboardButton(
+        text=f"🌟 {SUBSCRIPTION_PRICES['month']['title']} - {SUBSCRIPTION_PRICES['month']['price']} Stars",
+        callback_data="subscribe_month"
+    )],
+    [InlineKeyboardButton(
+        text=f"✨ {SUBSCRIPTION_PRICES['year']['title']} - {SUBSCRIPTION_PRICES['year']['price']} Stars",
+        callback_data="subscribe_year"
+    )]
+])
+
+_START_KB = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="📊 Моя статистика", callback_data="my_stats")],
+    [InlineKeyboardButton(text="💎 Подписка", callback_data="subscription_info")]
+])
+
+_ADMIN_KB = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="📊 Общая статистика", callback_data="admin_general")],
+    [InlineKeyboardButton(text="👥 Пользователи", callback_data="admin_users")],
+    [InlineKeyboardButton(text="💰 Финансы", callback_data="admin_finance")],
+    [InlineKeyboardButton(text="🔝 Топ пользователей", callback_data="admin_top")],
+    [InlineKeyboardButton(text="📢 Рассылка", callback_data="admin_broadcast")]
+])
+
+_MEDALS = ("🥇", "🥈", "🥉")
+
+# Рассылка: лимит Telegram ~30 сообщений в секунду
+BROADCAST_RATE = 29
+BROADCAST_CONCURRENCY = 30
+BROADCAST_PROGRESS_STEP = 500
+BROADCAST_BATCH = 1000
+
+# Как часто деактивировать истекшие подписки (секунды)
+SUBSCRIPTION_SWEEP_INTERVAL = 3600
+
+# Кэширование подписок и остатка запросов (данные меняются редко)
+SUBSCRIPTION_CACHE_TTL = 30
+REMAINING_CACHE_TTL = 5
+CACHE_MAX_USERS = 10_000
+_sub_cache = TTLCache(ttl=SUBSCRIPTION_CACHE_TTL, maxsize=CACHE_MAX_USERS)
+_remaining_cache = TTLCache(ttl=REMAINING_CACHE_TTL, maxsize=CACHE_MAX_USERS)
+
+# Кэш ответов на короткие вопросы без истории диалога
+PROMPT_CACHE_TTL = 3600
+PROMPT_CACHE_SIZE = 2048
+PROMPT_CACHE_MAX_PROMPT_LENGTH = 256
+_prompt_cache = TTLCache(ttl=PROMPT_CACHE_TTL, maxsize=PROMPT_CACHE_SIZE)
+
 # Состояния для FSM
 class AdminStates(StatesGroup):
     waiting_broadcast = State()
@@ -130,77 +210,147 @@ def is_admin(user_id: int) -> bool:
     """Проверка является ли пользователь админом"""
     return user_id in ADMIN_IDS
 
+async def cached_subscription(user_id: int) -> dict:
+    """Информация о подписке с кэшированием на SUBSCRIPTION_CACHE_TTL секунд"""
+    subscription = _sub_cache.get(user_id)
+    if subscription is None:
+        subscription = await db.get_subscription_info(user_id)
+        _sub_cache.set(user_id, subscription)
+    return subscription
+
+async def cached_remaining(user_id: int) -> int:
+    """Остаток запросов на сегодня с кэшированием на REMAINING_CACHE_TTL секунд"""
+    remaining = _remaining_cache.get(user_id)
+    if remaining is None:
+        remaining = await db.get_remaining_requests(user_id)
+        _remaining_cache.set(user_id, remaining)
+    return remaining
+
+async def _keep_typing(chat_id: int):
+    """Повторяет действие "печатает", пока задачу не отменят"""
+    while True:
+        try:
+            await bot.send_chat_action(chat_id, "typing")
+        except Exception as e:
+            logger.warning("Не удалось отправить chat action в чат %s: %s", chat_id, e)
+            return
+        await asyncio.sleep(TYPING_INTERVAL)
+
+async def _delete_quietly(message: Message):
+    """Удаляет служебное сообщение, не прерывая обработку при ошибке"""
+    try:
+        await message.delete()
+    except Exception as e:
+        logger.warning("Не удалось удалить сообщение %s: %s", message.message_id, e)
+
+async def _show_stream_preview(placeholder: Message, text: str):
+    """Показывает текущий фрагмент ответа обычным текстом, без разметки"""
+    preview = text[:MAX_MESSAGE_LENGTH - len(STREAM_CURSOR)] + STREAM_CURSOR
+    try:
+        await placeholder.edit_text(preview)
+    except Exception as e:
+        logger.debug("Не удалось обновить черновик ответа: %s", e)
+
+async def stream_completion(payload: dict, placeholder: Message) -> tuple[str, dict, str]:
+    """
+    Запрашивает ответ модели потоком (SSE) и по мере генерации обновляет placeholder.
+    Возвращает (текст ответа, usage, finish_reason)
+    """
+    payload = {**payload, "stream": True, "usage": {"include": True}}
+    
+    chunks = []
+    text_length = 0
+    shown_length = 0
+    usage = {}
+    finish_reason = None
+    last_edit = time.monotonic()
+    
+    async with aio_session.post(API_URL, headers=_AUTH_HEADERS, json=payload) as response:
+        response.raise_for_status()
+        async for raw_line in response.content:
+            line = raw_line.decode("utf-8").strip()
+            # Пустые строки и SSE-комментарии (": OPENROUTER PROCESSING") пропускаем
+            if not line.startswith("data:"):
+                continue
+            data = line[5:].strip()
+            if data == "[DONE]":
+                break
+            
+            event = json.loads(data)
+            if "error" in event:
+                raise aiohttp.ClientPayloadError(f"OpenRouter: {event['error']}")
+            if event.get("usage"):
+                usage = event["usage"]
+            
+            for choice in event.get("choices", []):
+                content = (choice.get("delta") or {}).get("content")
+                if content:
+                    chunks.append(content)
+                    text_length += len(content)
+                if choice.get("finish_reason"):
+                    finish_reason = choice["finish_reason"]
+            
+            # Обновляем черновик не чаще STREAM_EDIT_INTERVAL (лимит Telegram на редактирование)
+            now = time.monotonic()
+            if (now - last_edit >= STREAM_EDIT_INTERVAL
+                    and text_length > shown_length
+                    and shown_length < MAX_MESSAGE_LENGTH):
+                await _show_stream_preview(placeholder, "".join(chunks))
+                shown_length = text_length
+                last_edit = time.monotonic()
+    
+    return "".join(chunks), usage, finish_reason
+
 def get_subscription_keyboard() -> InlineKeyboardMarkup:
     """Клавиатура с вариантами подписки"""
-    keyboard = [
-        [InlineKeyboardButton(
-            text=f"⭐️ {SUBSCRIPTION_PRICES['week']['title']} - {SUBSCRIPTION_PRICES['week']['price']} Stars",
-            callback_data="subscribe_week"
-        )],
-        [InlineKeyboardButton(
-            text=f"🌟 {SUBSCRIPTION_PRICES['month']['title']} - {SUBSCRIPTION_PRICES['month']['price']} Stars",
-            callback_data="subscribe_month"
-        )],
-        [InlineKeyboardButton(
-            text=f"✨ {SUBSCRIPTION_PRICES['year']['title']} - {SUBSCRIPTION_PRICES['year']['price']} Stars",
-            callback_data="subscribe_year"
-        )]
-    ]
-    return InlineKeyboardMarkup(inline_keyboard=keyboard)
+    return _SUBSCRIPTION_KB
 
 @dp.message(CommandStart())
 async def start_handler(message: Message):
     user_id = message.from_user.id
 
-    logger.info(f"Команда /start от пользователя {user_id}")
+    logger.info("Команда /start от пользователя %s", user_id)
     
     try:
         # Добавляем пользователя и очищаем историю
-        it_new_user = not(db.check_user(user_id))
-        if (it_new_user):
-            logging.info(f"Add new user: {user_id}")
-            username = message.from_user.username or "Нет username"
-            full_name = message.from_user.full_name
-
-            db.add_user(user_id, username, full_name)
+        username = message.from_user.username or "Нет username"
+        full_name = message.from_user.full_name
+        it_new_user = await db.add_user(user_id, username, full_name)
+        if it_new_user:
+            logger.info("Add new user: %s", user_id)
             
-        db.clear_history(user_id)
-        logger.info(f"История очищена для пользователя {user_id}")
+        await db.clear_history(user_id)
+        logger.info("История очищена для пользователя %s", user_id)
         
         # Проверяем статус подписки
-        subscription_info = db.get_subscription_info(user_id)
+        subscription_info = await cached_subscription(user_id)
         has_subscription = subscription_info['is_active']
         
-        keyboard = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="📊 Моя статистика", callback_data="my_stats")],
-            [InlineKeyboardButton(text="💎 Подписка", callback_data="subscription_info")]
-        ])
-        
         welcome_text = (
             "👋 <b>Привет! Я умный AI-ассистент</b>\n\n"
             "💬 Просто напиши мне сообщение, и я помогу!\n\n"
         )
-        remaining = db.get_remaining_requests(user_id)
+        remaining = await cached_remaining(user_id)
         if has_subscription:
             
             welcome_text += (
                 f"✅ У вас активна подписка до {subscription_info['expires_at']}\n"
                 f"💎 У вас доступно: {remaining} запросов сегодня!"
             )
-            logger.info(f"Пользователь {user_id} имеет активную подписку до {subscription_info['expires_at']}")
+            logger.info("Пользователь %s имеет активную подписку до %s", user_id, subscription_info['expires_at'])
         else:
             welcome_text += (
                 f"🔍 У вас доступно: {remaining} запросов сегодня\n"
                 "💎 Купите <b>подписку</b> для доступа и увеличения количества запросов."
             )
-            logger.info(f"Пользователь {user_id} имеет {remaining}/{FREE_DAILY_LIMIT} бесплатных запросов")
+            logger.info("Пользователь %s имеет %s/%s бесплатных запросов", user_id, remaining, FREE_DAILY_LIMIT)
         
-        logger.info(f"Приветственное сообщение отправлено пользователю {user_id}")
+        logger.info("Приветственное сообщение отправлено пользователю %s", user_id)
 
-        await message.answer(welcome_text, reply_markup=keyboard, parse_mode=ParseMode.HTML)
+        await message.answer(welcome_text, reply_markup=_START_KB, parse_mode=ParseMode.HTML)
         
     except Exception as e:
-        logger.error(f"Ошибка в start_handler для пользователя {user_id}: {e}", exc_info=True)
+        logger.error("Ошибка в start_handler для пользователя %s: %s", user_id, e, exc_info=True)
         await message.answer("❌ Произошла ошибка. Попробуйте позже.")
 
 @dp.message(Command("stats"))
@@ -208,9 +358,9 @@ async def stats_command(message: Message, user_id: int = None):
     """Статистика пользователя"""
     if (user_id == None):
         user_id = message.from_user.id
-    logger.info(f'stat {user_id}')
-    stats = db.get_user_stats(user_id)
-    subscription = db.get_subscription_info(user_id)
+    logger.info('stat %s', user_id)
+    stats = await db.get_user_stats(user_id)
+    subscription = await cached_subscription(user_id)
     
     if stats:
         status = "✅ Активна" if subscription['is_active'] else "❌ Не активна"
@@ -250,8 +400,8 @@ async def subscribe_command(message: Message, user_id: int = None):
     """Информация о подписке"""
     if (user_id == None):
         user_id = message.from_user.id
-    logger.info(f"sub {user_id}")
-    subscription = db.get_subscription_info(user_id)
+    logger.info("sub %s", user_id)
+    subscription = await cached_subscription(user_id)
     
     if subscription['is_active']:
         await message.answer(
@@ -283,26 +433,30 @@ async def admin_panel(message: Message):
         await message.answer("❌ У вас нет доступа к админ-панели")
         return
     
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="📊 Общая статистика", callback_data="admin_general")],
-        [InlineKeyboardButton(text="👥 Пользователи", callback_data="admin_users")],
-        [InlineKeyboardButton(text="💰 Финансы", callback_data="admin_finance")],
-        [InlineKeyboardButton(text="🔝 Топ пользователей", callback_data="admin_top")],
-        [InlineKeyboardButton(text="📢 Рассылка", callback_data="admin_broadcast")]
-    ])
-    
     await message.answer(
         "🔐 <b>Админ-панель</b>\n\nВыберите действие:",
-        reply_markup=keyboard,
+        reply_markup=_ADMIN_KB,
         parse_mode=ParseMode.HTML
     )
 
+@dp.message(Command("flushcache"))
+async def flush_cache_command(message: Message):
+    """Очистка кэша ответов модели"""
+    if not is_admin(message.from_user.id):
+        await message.answer("❌ У вас нет доступа к этой команде")
+        return
+    
+    cached = len(_prompt_cache)
+    _prompt_cache.clear()
+    logger.info("Кэш ответов очищен администратором %s (%s записей)", message.from_user.id, cached)
+    await message.answer(f"🧹 Кэш ответов очищен: {cached} записей")
+
 @dp.callback_query(F.data == "my_stats")
 async def my_stats_callback(callback: types.CallbackQuery):
     await stats_command(callback.message, callback.from_user.id)
     await callback.answer()
 
-@dp.callback_query(F.data == "subscription_info" or F.data == "subscribe")
+@dp.callback_query(F.data.in_({"subscription_info", "subscribe"}))
 async def subscription_info_callback(callback: types.CallbackQuery):
     await subscribe_command(callback.message, callback.from_user.id)
     await callback.answer()
@@ -341,9 +495,11 @@ async def successful_payment_handler(message: Message):
         days = SUBSCRIPTION_PRICES[period]['days']
         price = SUBSCRIPTION_PRICES[period]['price']
         
-        logger.info(f"Успешный платеж от пользователя {user_id}: {price} Stars за {days} дней ({period})")
+        logger.info("Успешный платеж от пользователя %s: %s Stars за %s дней (%s)", user_id, price, days, period)
         
-        db.add_subscription(user_id, days, price)
+        await db.add_subscription(user_id, days, price)
+        _sub_cache.pop(user_id, None)
+        _remaining_cache.pop(user_id, None)
         
         await message.answer(
             f"✅ <b>Оплата прошла успешно!</b>\n\n"
@@ -353,10 +509,10 @@ async def successful_payment_handler(message: Message):
             parse_mode=ParseMode.HTML
         )
         
-        logger.info(f"Подписка успешно активирована для пользователя {user_id}")
+        logger.info("Подписка успешно активирована для пользователя %s", user_id)
         
     except Exception as e:
-        logger.error(f"Ошибка при обработке платежа: {e}", exc_info=True)
+        logger.error("Ошибка при обработке платежа: %s", e, exc_info=True)
         await message.answer("❌ Ошибка при активации подписки. Обратитесь в поддержку.")
 
 @dp.callback_query(F.data == "admin_general")
@@ -365,7 +521,7 @@ async def admin_general_callback(callback: types.CallbackQuery):
         await callback.answer("❌ Нет доступа", show_alert=True)
         return
     
-    stats = db.get_general_stats()
+    stats = await db.get_general_stats()
     
     await callback.message.answer(
         f"📊 <b>Общая статистика бота:</b>\n\n"
@@ -392,16 +548,17 @@ async def admin_users_callback(callback: types.CallbackQuery):
         await callback.answer("❌ Нет доступа", show_alert=True)
         return
     
-    recent_users = db.get_recent_users(limit=10)
+    recent_users = await db.get_recent_users(limit=10)
     
-    message_text = "👥 <b>Последние 10 пользователей:</b>\n\n"
+    parts = ["👥 <b>Последние 10 пользователей:</b>\n\n"]
     for i, user in enumerate(recent_users, 1):
         sub_status = "💎" if user['has_subscription'] else "🆓"
-        message_text += (
+        parts.append(
             f"{i}. {sub_status} @{user['username']}\n"
             f"   └ {user['full_name']}\n"
             f"   └ Сообщений: {user['message_count']} | Рег: {user['registration_date']}\n\n"
         )
+    message_text = "".join(parts)
     
     await callback.message.answer(message_text, parse_mode=ParseMode.HTML)
     await callback.answer()
@@ -412,7 +569,7 @@ async def admin_finance_callback(callback: types.CallbackQuery):
         await callback.answer("❌ Нет доступа", show_alert=True)
         return
     
-    finance = db.get_finance_stats()
+    finance = await db.get_finance_stats()
     
     await callback.message.answer(
         f"💰 <b>Финансовая статистика:</b>\n\n"
@@ -437,16 +594,17 @@ async def admin_top_callback(callback: types.CallbackQuery):
         await callback.answer("❌ Нет доступа", show_alert=True)
         return
     
-    top_users = db.get_top_users(limit=10)
+    top_users = await db.get_top_users(limit=10)
     
-    message_text = "🔝 <b>Топ-10 пользователей:</b>\n\n"
+    parts = ["🔝 <b>Топ-10 пользователей:</b>\n\n"]
     for i, user in enumerate(top_users, 1):
-        medal = ["🥇", "🥈", "🥉"][i-1] if i <= 3 else f"{i}."
-        message_text += (
+        medal = _MEDALS[i-1] if i <= len(_MEDALS) else f"{i}."
+        parts.append(
             f"{medal} @{user['username']}\n"
             f"   └ {user['full_name']}\n"
             f"   └ Сообщений: {user['message_count']} | Затраты: ${user['total_cost']:.4f}\n\n"
         )
+    message_text = "".join(parts)
     
     await callback.message.answer(message_text, parse_mode=ParseMode.HTML)
     await callback.answer()
@@ -466,19 +624,77 @@ async def process_broadcast(message: Message, state: FSMContext):
     if not is_admin(message.from_user.id):
         return
     
-    users = db.get_all_user_ids()
-    success = 0
-    failed = 0
-    
     status_msg = await message.answer("📤 Начинаю рассылку...")
     
-    for user_id in users:
-        try:
-            await bot.send_message(user_id, message.text, parse_mode=ParseMode.HTML)
-            success += 1
-            await asyncio.sleep(0.05)
-        except Exception:
-            failed += 1
+    limiter = AsyncLimiter(BROADCAST_RATE, 1)
+    # В памяти держим не больше двух порций ID: одна в очереди, одна на подходе
+    pending = asyncio.Queue(maxsize=2 * BROADCAST_BATCH)
+    progress = asyncio.Queue()
+    completed = 0
+    success = 0
+
+    async def produce():
+        after_id = 0
+        while True:
+            batch = await db.get_user_ids_batch(after_id, BROADCAST_BATCH)
+            if not batch:
+                break
+            for user_id in batch:
+                await pending.put(user_id)
+            after_id = batch[-1]
+
+    async def send_one(user_id: int) -> bool:
+        for attempt in range(2):
+            async with limiter:
+                try:
+                    await bot.send_message(user_id, message.text, parse_mode=ParseMode.HTML)
+                    return True
+                except TelegramRetryAfter as e:
+                    retry_after = e.retry_after
+                except Exception:
+                    # Заблокировавшие бота и удалённые аккаунты - повторять бессмысленно
+                    return False
+            # Telegram просит подождать (429) - ждём и пробуем ещё раз
+            if attempt == 0:
+                await asyncio.sleep(retry_after)
+        return False
+
+    async def worker():
+        nonlocal completed, success
+        while True:
+            user_id = await pending.get()
+            if user_id is None:
+                return
+            if await send_one(user_id):
+                success += 1
+            completed += 1
+            if completed % BROADCAST_PROGRESS_STEP == 0:
+                progress.put_nowait(completed)
+
+    async def report_progress():
+        # Обновляем статус не чаще, чем раз в BROADCAST_PROGRESS_STEP отправок
+        while True:
+            count = await progress.get()
+            while not progress.empty():
+                count = progress.get_nowait()
+            try:
+                await status_msg.edit_text(f"📤 Рассылка: отправлено {count}")
+            except Exception as e:
+                logger.warning("Не удалось обновить статус рассылки: %s", e)
+
+    reporter = asyncio.create_task(report_progress())
+    workers = [asyncio.create_task(worker()) for _ in range(BROADCAST_CONCURRENCY)]
+    try:
+        await produce()
+        for _ in workers:
+            await pending.put(None)
+        await asyncio.gather(*workers)
+    finally:
+        for task in workers:
+            task.cancel()
+        reporter.cancel()
+
+    failed = completed - success
     
     await status_msg.edit_text(
         f"✅ Рассылка завершена!\n\n"
@@ -487,36 +703,38 @@ async def process_broadcast(message: Message, state: FSMContext):
     )
     await state.clear()
 
-def split_message(text):
-    return [text[i:i+MAX_MESSAGE_LENGTH] for i in range(0, len(text), MAX_MESSAGE_LENGTH)]
-
 @dp.message()
 async def chat_handler(message: Message):
     user_id = message.from_user.id
     message_text = message.text[:100] + "..." if len(message.text) > 100 else message.text
 
-    it_new_user = not(db.check_user(user_id))
-    if it_new_user:
-        logging.info(f"Add new user: {user_id} from message")
+    # Подписка, лимиты, активность и история - одним обращением к БД
+    context = await db.get_chat_context(user_id, HISTORY_LIMIT)
+
+    it_new_user = False
+    if not context.exists:
         username = message.from_user.username or "Нет username"
         full_name = message.from_user.full_name
-        
-        db.add_user(user_id, username, full_name)
+        it_new_user = await db.add_user(user_id, username, full_name)
+        if it_new_user:
+            logger.info("Add new user: %s from message", user_id)
 
-    logger.info(f"Получено сообщение от пользователя {user_id}")
+    logger.info("Получено сообщение от пользователя %s", user_id)
+    answer = None
     
     try:
         # Проверяем лимиты
-        subscription = db.get_subscription_info(user_id)
+        subscription = context.subscription
+        _sub_cache.set(user_id, subscription)
 
         is_premium = subscription and subscription.get('is_active', False)
         daily_limit = PREMIUM_DAILY_LIMIT if is_premium else FREE_DAILY_LIMIT
+        remaining = context.remaining
         if not is_premium:
-            remaining = db.get_remaining_requests(user_id)
-            logger.info(f"Пользователь {user_id} без подписки, осталось запросов: {remaining}/{daily_limit}")
+            logger.info("Пользователь %s без подписки, осталось запросов: %s/%s", user_id, remaining, daily_limit)
             
             if remaining <= 0:
-                logger.warning(f"Пользователь {user_id} исчерпал лимит бесплатных запросов")
+                logger.warning("Пользователь %s исчерпал лимит бесплатных запросов", user_id)
                 await message.answer(
                     "⚠️ <b>Вы исчерпали дневной лимит бесплатных запросов!</b>\n\n"
                     "💎 Оформите подписку, чтобы получить больше запросов.:",
@@ -528,27 +746,23 @@ async def chat_handler(message: Message):
             # 1. Проверяем, когда пользователь делал запрос в последний раз
             delay_seconds = 0
              
-            time_dict = db.get_user_last_act(user_id)
-            last_time_str = time_dict.get('last_activity')
-            current_time_str  = time_dict.get('current_time')
-            if last_time_str:
-                last_time = datetime.strptime(last_time_str, "%Y-%m-%d %H:%M:%S")
-                current_time = datetime.strptime(current_time_str, "%Y-%m-%d %H:%M:%S")
-                time_since_last = current_time - last_time
-                min_interval = timedelta(seconds=COOLDOWN_SECONDS)
-
-                if time_since_last < min_interval:
-                    remaining_time = min_interval - time_since_last
-                    delay_seconds = int(remaining_time.total_seconds()) + 1
-                    logging.info(
-                        f"Пользователь {user_id} слишком рано сделал запрос. "
-                        f"Последний запрос: {last_time}, текущее время: {current_time}, "
-                        f"прошло: {time_since_last}, осталось секунд: {delay_seconds}"
+            last_ts = context.last_activity_ts
+            current_ts = int(time.time())
+            if last_ts:
+                time_since_last = current_ts - last_ts
+
+                if time_since_last < COOLDOWN_SECONDS:
+                    delay_seconds = COOLDOWN_SECONDS - time_since_last + 1
+                    logger.info(
+                        "Пользователь %s слишком рано сделал запрос. "
+                        "Последний запрос: %s, текущее время: %s, "
+                        "прошло: %s сек, осталось секунд: %s",
+                        user_id, last_ts, current_ts, time_since_last, delay_seconds
                     )
                 else:
-                    logging.info(f"Пользователь {user_id} сделал запрос. Прошло времени с последнего запроса: {time_since_last}")
+                    logger.info("Пользователь %s сделал запрос. Прошло времени с последнего запроса: %s сек", user_id, time_since_last)
             else:
-                logging.info(f"Пользователь {user_id} делает первый запрос.")
+                logger.info("Пользователь %s делает первый запрос.", user_id)
             if it_new_user:
                 pass
             elif delay_seconds > 0:
@@ -559,107 +773,141 @@ async def chat_handler(message: Message):
             #elif delay_info.get('was_delayed', False): # Задержка только что закончилась    await message.answer(        "✅ Теперь вы можете отправить запрос!",        parse_mode=ParseMode.HTML    )
                 return
         else:
-            remaining = db.get_remaining_requests(user_id)
-            logger.info(f"Пользователь {user_id}, осталось запросов: {remaining}/{daily_limit}")
+            logger.info("Пользователь %s, осталось запросов: %s/%s", user_id, remaining, daily_limit)
             
             if remaining <= 0:
-                logger.warning(f"Пользователь {user_id} исчерпал лимит запросов")
+                logger.warning("Пользователь %s исчерпал лимит запросов", user_id)
                 await message.answer(
                     f"⚠️ <b>Вы исчерпали дневной лимит запросов!</b>\n\n"
                     f"🔄 Лимит обновится через <b>день</b>.\n\n",
                     parse_mode=ParseMode.HTML
                 )
                 return
-        await bot.send_chat_action(message.chat.id, "typing")
-        await asyncio.sleep(3)
-        # Получаем историю
-        history = db.get_history(user_id)
-        logger.debug(f"Загружена история для пользователя {user_id}: {len(history)} сообщений")
+        history = context.history
+        logger.debug("Загружена история для пользователя %s: %s сообщений", user_id, len(history))
         
         messages = [
-            {"role": "system", "content": "Ты дружелюбный ассистент. Используй Markdown для форматирования: **жирный**, *курсив*, `код`, ```блоки кода```."}
+            _SYSTEM_MSG,
+            *({"role": msg['role'], "content": msg['content']} for msg in history),
+            {"role": "user", "content": message.text}
         ]
         
-        for msg in history:
-            messages.append({"role": msg['role'], "content": msg['content']})
-        
-        messages.append({"role": "user", "content": message.text})
-        
         max_tokens = get_adaptive_max_tokens(len(history))
-        logger.debug(f"Используется max_tokens: {max_tokens}")
-        
-        headers = {
-            "Authorization": f"Bearer {OPENROUTER_API_KEY}",
-            "Content-Type": "application/json",
-        }
-        payload = {
-            "model": MODEL,
-            "messages": messages,
-            "max_tokens": max_tokens
-        }
-        
-        logger.info(f"Отправка запроса к OpenRouter API для пользователя {user_id}")
-        response = requests.post(API_URL, headers=headers, json=payload, timeout=30)
-        response.raise_for_status()
-        data = response.json()
-        
-        answer = data["choices"][0]["message"]["content"]
+        logger.debug("Используется max_tokens: %s", max_tokens)
         
-        usage = data.get("usage", {})
-        input_tokens = usage.get("prompt_tokens", 0)
-        output_tokens = usage.get("completion_tokens", 0)
-        cost = calculate_cost(input_tokens, output_tokens)
+        # Ответы на одинаковые короткие вопросы без контекста берем из кэша
+        cache_key = None
+        if not history and len(message.text) < PROMPT_CACHE_MAX_PROMPT_LENGTH:
+            cache_key = (MODEL, max_tokens, " ".join(message.text.lower().split()))
+        cached_answer = _prompt_cache.get(cache_key) if cache_key else None
+        placeholder = None
         
-        logger.info(
-            f"Ответ получен для пользователя {user_id}. "
-            f"Токены: {input_tokens} вход, {output_tokens} выход. "
-            f"Стоимость: ${cost:.6f}"
-        )
+        if cached_answer is not None:
+            answer = cached_answer
+            input_tokens = output_tokens = 0
+            cost = 0.0
+            logger.info("Ответ для пользователя %s взят из кэша", user_id)
+        else:
+            payload = {
+                "model": MODEL,
+                "messages": messages,
+                "max_tokens": max_tokens
+            }
+            
+            logger.info("Отправка запроса к OpenRouter API для пользователя %s", user_id)
+            placeholder = await message.answer(STREAM_CURSOR)
+            # Индикатор "печатает" держим, пока модель генерирует ответ. Задачу создаем
+            # только после черновика, иначе при ошибке отправки ее некому отменить
+            typing_task = asyncio.create_task(_keep_typing(message.chat.id))
+            try:
+                streamed_text, usage, finish_reason = await stream_completion(payload, placeholder)
+            except Exception:
+                await _delete_quietly(placeholder)
+                raise
+            finally:
+                typing_task.cancel()
+            
+            if not streamed_text:
+                await _delete_quietly(placeholder)
+                raise ValueError(f"Пустой ответ модели (finish_reason={finish_reason})")
+            answer = streamed_text
+            # Кэшируем только полностью сгенерированные ответы
+            if cache_key and finish_reason == "stop":
+                _prompt_cache.set(cache_key, answer)
+            
+            input_tokens = usage.get("prompt_tokens", 0)
+            output_tokens = usage.get("completion_tokens", 0)
+            cost = calculate_cost(input_tokens, output_tokens)
+            
+            logger.info(
+                "Ответ получен для пользователя %s. "
+                "Токены: %s вход, %s выход. "
+                "Стоимость: $%.6f",
+                user_id, input_tokens, output_tokens, cost
+            )
         
         formatted_answer = markdown_to_html(answer)
         
-        # Разбиваем умным способом
-        message_parts = smart_split_message(formatted_answer, max_length=4096)
-
-        # Отправляем части
-        if len(message_parts) > 1:
-            for i, part in enumerate(message_parts, 1):
+        # Части отправляются по мере нарезки; короткий ответ придет одной частью
+        message_parts = smart_split_message(formatted_answer, max_length=MAX_MESSAGE_LENGTH)
+        
+        # Первая часть заменяет черновик, который обновлялся во время генерации
+        for i, part in enumerate(message_parts, 1):
+            if i == 1 and placeholder is not None:
+                await placeholder.edit_text(part, parse_mode=ParseMode.HTML)
+            else:
                 await message.answer(part, parse_mode=ParseMode.HTML)
-                logger.info(f"Отправлена часть {i}/{len(message_parts)} пользователю {user_id}")
-        else:
-            await message.answer(formatted_answer, parse_mode=ParseMode.HTML)
-            logger.info(f"Ответ отправлен пользователю {user_id}")
+            logger.info("Отправлена часть %s пользователю %s", i, user_id)
 
-    except requests.exceptions.Timeout:
-        logger.error(f"Timeout при запросе к API для пользователя {user_id}")
+    except asyncio.TimeoutError:
+        logger.error("Timeout при запросе к API для пользователя %s", user_id)
         await message.answer("⏳ К сожалению, время ожидания ответа сервиса истекло. Пожалуйста, попробуйте повторить запрос чуть позже.")
 
-    except requests.exceptions.RequestException as e:
-        logger.error(f"Ошибка запроса к API для пользователя {user_id}: {e}", exc_info=True)
+    except aiohttp.ClientError as e:
+        logger.error("Ошибка запроса к API для пользователя %s: %s", user_id, e, exc_info=True)
         await message.answer("⚠️ Возникла временная трудность при обращении к сервису. Мы уже работаем над её устранением. Попробуйте снова через некоторое время.")
 
     except Exception as e:
-        logger.error(f"Неожиданная ошибка в chat_handler для пользователя {user_id}: {e}", exc_info=True)
+        logger.error("Неожиданная ошибка в chat_handler для пользователя %s: %s", user_id, e, exc_info=True)
         await message.answer("❌ Произошла непредвиденная ошибка. Наша команда уже уведомлена, и мы постараемся всё исправить как можно скорее.")
 
     finally:
-        # Сохраняем в историю
-        db.add_message(user_id, "user", message.text)
-        db.add_message(user_id, "assistant", answer)
-        db.update_stats(user_id, input_tokens, output_tokens, cost)
+        # Сохраняем в историю и обновляем статистику одной транзакцией
+        if answer is not None:
+            await db.finalize_message(user_id, message.text, answer, input_tokens, output_tokens, cost)
+            _remaining_cache.pop(user_id, None)
+
+async def sweep_subscriptions():
+    """Периодически деактивирует истекшие подписки вне пути обработки сообщений"""
+    while True:
+        try:
+            count = await db.sweep_expired_subscriptions()
+            if count:
+                logger.info("Деактивировано истекших подписок: %s", count)
+        except Exception as e:
+            logger.error("Ошибка при деактивации подписок: %s", e)
+        await asyncio.sleep(SUBSCRIPTION_SWEEP_INTERVAL)
 
 async def main():
+    global aio_session
     logger.info("="*50)
     logger.info("🤖 Бот запущен и готов к работе!")
-    logger.info(f"Модель: {MODEL}")
-    logger.info(f"Бесплатный лимит: {FREE_DAILY_LIMIT} запросов/день")
+    logger.info("Модель: %s", MODEL)
+    logger.info("Бесплатный лимит: %s запросов/день", FREE_DAILY_LIMIT)
     logger.info("="*50)
     
+    # sock_read ограничивает паузу между фрагментами потока, total - весь ответ
+    aio_session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=120, sock_read=30))
+    sweeper = asyncio.create_task(sweep_subscriptions())
     try:
         await dp.start_polling(bot)
     except Exception as e:
-        logger.critical(f"Критическая ошибка при запуске бота: {e}", exc_info=True)
+        logger.critical("Критическая ошибка при запуске бота: %s", e, exc_info=True)
         raise
+    finally:
+        sweeper.cancel()
+        await aio_session.close()
+        await db.close()
 
 if __name__ == "__main__":
     try:
@@ -667,4 +915,7 @@ if __name__ == "__main__":
     except KeyboardInterrupt:
         logger.info("Бот остановлен пользователем (Ctrl+C)")
     except Exception as e:
-        logger.critical(f"Неожиданная ошибка: {e}", exc_info=True)
\ No newline at end of file
+        logger.critical("Неожиданная ошибка: %s", e, exc_info=True)
+    finally:
+        # Дописываем оставшиеся в очереди записи
+        log_listener.stop()
\ No newline at end of file
@@ -1,5 +1,12 @@
 # database.py - Работа с базой данных
+import asyncio
+import functools
+import inspect
 import sqlite3
+import queue
+import threading
+from contextlib import contextmanager
+from dataclasses import dataclass
 from datetime import datetime, timedelta, date
 from typing import List, Dict, Optional
 import os
@@ -9,24 +16,229 @@ from dotenv import load_dotenv
 load_dotenv()
 
 
-FREE_DAILY_LIMIT = int(os.getenv("FREE_DAILY_LIMIT"))
-PREMIUM_DAILY_LIMIT = int(os.getenv("PREMIUM_DAILY_LIMIT"))
+FREE_DAILY_LIMIT = int(os.getenv("FREE_DAILY_LIMIT", "10"))
+PREMIUM_DAILY_LIMIT = int(os.getenv("PREMIUM_DAILY_LIMIT", "110"))
+# Сколько последних сообщений каждого пользователя хранить в истории
+HISTORY_KEEP_MESSAGES = int(os.getenv("HISTORY_KEEP_MESSAGES", "50"))
+# Сообщения моложе этого срока не удаляются: по ним считается статистика за 30 дней
+HISTORY_KEEP_DAYS = 31
+
+
+# Даты хранятся в ISO-формате, драйвер сам превращает их в datetime/date
+# для колонок, объявленных как TIMESTAMP/DATE (или помеченных "имя [timestamp]")
+def _adapt_datetime(value: datetime) -> str:
+    return value.isoformat(" ")
+
+def _adapt_date(value: date) -> str:
+    return value.isoformat()
+
+def _convert_timestamp(value: bytes) -> datetime:
+    return datetime.fromisoformat(value.decode())
+
+def _convert_date(value: bytes) -> date:
+    return date.fromisoformat(value.decode())
+
+sqlite3.register_adapter(datetime, _adapt_datetime)
+sqlite3.register_adapter(date, _adapt_date)
+sqlite3.register_converter("TIMESTAMP", _convert_timestamp)
+sqlite3.register_converter("DATE", _convert_date)
+
+# Запросы горячего пути. Один и тот же текст SQL попадает в кэш подготовленных
+# выражений соединения, и sqlite не разбирает его заново на каждом вызове
+_SQL_ADD_MESSAGE = """
+    INSERT INTO message_history (user_id, role, content)
+    VALUES (?, ?, ?)
+"""
+
+# Последние сообщения выбираются по индексу в обратном порядке,
+# а внешний запрос сразу возвращает их в хронологическом
+_SQL_HISTORY = """
+    SELECT role, content, timestamp
+    FROM (
+        SELECT id, role, content, timestamp
+        FROM message_history
+        WHERE user_id = ?
+        ORDER BY id DESC
+        LIMIT ?
+    )
+    ORDER BY id
+"""
+
+# Счетчик запросов и окончание действующей подписки одним запросом.
+# end_date хранится в локальном времени, поэтому "сейчас" передается из Python
+_SQL_REMAINING = """
+    SELECT 
+        u.today_requests,
+        u.last_request_date,
+        (
+            SELECT MAX(s.end_date)
+            FROM subscriptions s
+            WHERE s.user_id = u.user_id AND s.is_active = 1 AND s.end_date > ?
+        ) AS sub_end
+    FROM users u
+    WHERE u.user_id = ?
+"""
+
+# Счетчик за день сбрасывается, если последний запрос был не сегодня
+_SQL_UPDATE_STATS = """
+    UPDATE users
+    SET today_requests = CASE WHEN last_request_date = ? THEN today_requests + 1 ELSE 1 END,
+        last_request_date = ?,
+        message_count = message_count + 1,
+        total_input_tokens = total_input_tokens + ?,
+        total_output_tokens = total_output_tokens + ?,
+        total_cost = total_cost + ?,
+        last_activity = CURRENT_TIMESTAMP
+    WHERE user_id = ?
+"""
+
+_SQL_ACTIVE_SUBSCRIPTION = """
+    SELECT end_date, is_active
+    FROM subscriptions
+    WHERE user_id = ? AND is_active = 1
+    ORDER BY end_date DESC
+    LIMIT 1
+"""
+
+_SQL_CHAT_CONTEXT = """
+    SELECT 
+        u.today_requests,
+        u.last_request_date,
+        CAST(strftime('%s', u.last_activity) AS INTEGER) AS last_activity_ts,
+        (
+            SELECT s.end_date
+            FROM subscriptions s
+            WHERE s.user_id = u.user_id AND s.is_active = 1
+            ORDER BY s.end_date DESC
+            LIMIT 1
+        ) AS "end_date [timestamp]"
+    FROM users u
+    WHERE u.user_id = ?
+"""
+
+
+@dataclass
+class ChatContext:
+    """Все данные о пользователе, нужные для обработки одного сообщения"""
+    exists: bool
+    subscription: Dict
+    remaining: int
+    last_activity_ts: Optional[int]
+    history: List[Dict]
+
+
+class ConnectionPool:
+    """Пул долгоживущих подключений к SQLite, общий для всех потоков"""
+
+    def __init__(self, db_name: str, size: int = 5):
+        self.db_name = db_name
+        self._connections = queue.Queue(maxsize=size)
+        for _ in range(size):
+            self._connections.put(self._create_connection())
+
+    def _create_connection(self) -> sqlite3.Connection:
+        """Создает подключение в режиме автокоммита; транзакции открываются явно через BEGIN"""
+        conn = sqlite3.connect(
+            self.db_name,
+            check_same_thread=False,
+            timeout=30,
+            isolation_level=None,
+            cached_statements=256,
+            detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES
+        )
+        conn.row_factory = sqlite3.Row
+        # Настройки действуют на соединение и применяются один раз при его создании:
+        # в WAL достаточно NORMAL (fsync только на чекпоинтах), кэш страниц - 64 МБ
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        conn.execute("PRAGMA cache_size=-65536")
+        conn.execute("PRAGMA mmap_size=268435456")
+        return conn
+
+    @contextmanager
+    def acquire(self):
+        """Берет подключение из пула и возвращает его обратно после использования"""
+        # None в очереди - свободный слот без подключения, его открываем здесь
+        conn = self._connections.get()
+        if conn is None:
+            try:
+                conn = self._create_connection()
+            except Exception:
+                self._connections.put(None)
+                raise
+        
+        try:
+            yield conn
+        except Exception:
+            # Подключение могло остаться посреди транзакции - закрываем его, а новое
+            # откроет следующий acquire. Так в пул не вернется закрытое подключение,
+            # даже если открыть новое сейчас не получится
+            conn.close()
+            conn = None
+            raise
+        finally:
+            self._connections.put(conn)
+
+    def close(self):
+        """Закрывает все подключения пула"""
+        while not self._connections.empty():
+            conn = self._connections.get_nowait()
+            if conn is not None:
+                conn.close()
+
+
 class Database:
-    def __init__(self, db_name: str = "bot_database.db"):
+    def __init__(self, db_name: str = "bot_database.db", pool_size: int = 5):
         self.db_name = db_name
         self.init_db()
+        self._pool = ConnectionPool(db_name, pool_size)
+        # Подключение открытой в потоке транзакции (см. transaction)
+        self._local = threading.local()
     
-    def get_connection(self):
-        """Создает подключение к БД"""
-        conn = sqlite3.connect(self.db_name)
-        conn.row_factory = sqlite3.Row
-        return conn
+    def close(self):
+        """Закрывает подключения к БД"""
+        self._pool.close()
+    
+    @contextmanager
+    def _connection(self):
+        """Подключение текущей транзакции потока или свободное подключение из пула"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            yield conn
+            return
+        with self._pool.acquire() as conn:
+            yield conn
+    
+    @contextmanager
+    def transaction(self):
+        """Объединяет все записи внутри блока в одну транзакцию с одним коммитом"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            # Вложенный вызов - работаем в уже открытой транзакции
+            yield conn
+            return
+        with self._pool.acquire() as conn:
+            # IMMEDIATE сразу берет блокировку на запись, чтобы не упираться в SQLITE_BUSY посреди транзакции
+            conn.execute("BEGIN IMMEDIATE")
+            self._local.conn = conn
+            try:
+                yield conn
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            finally:
+                self._local.conn = None
     
     def init_db(self):
         """Инициализация базы данных"""
-        conn = self.get_connection()
+        # Отдельное подключение только для создания схемы
+        conn = sqlite3.connect(self.db_name)
         cursor = conn.cursor()
-        
+
+        # WAL: читатели не блокируют писателей (режим сохраняется в файле БД)
+        cursor.execute("PRAGMA journal_mode=WAL")
+
         # Таблица пользователей
         cursor.execute("""
             CREATE TABLE IF NOT EXISTS users (
@@ -72,250 +284,247 @@ class Database:
         
         # Индексы
         cursor.execute("CREATE INDEX IF NOT EXISTS idx_user_messages ON message_history(user_id, timestamp)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_user_history ON message_history(user_id, id)")
         cursor.execute("CREATE INDEX IF NOT EXISTS idx_last_activity ON users(last_activity)")
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_subscriptions ON subscriptions(user_id, is_active)")
+        # Активная подписка с максимальной end_date берется прямо из индекса
+        cursor.execute("DROP INDEX IF EXISTS idx_subscriptions")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_sub_user ON subscriptions(user_id, is_active, end_date)")
+        # Для статистики: активные подписки без фильтра по пользователю и сообщения за период
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_sub_active_end ON subscriptions(is_active, end_date)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_msg_ts ON message_history(timestamp)")
+        
+        # История не растет бесконечно: после вставки удаляем сообщения пользователя,
+        # которые старше последних HISTORY_KEEP_MESSAGES и старше HISTORY_KEEP_DAYS дней,
+        # чтобы не терять данные статистики за период. timestamp пишется в UTC, как и
+        # datetime('now'). Триггер пересоздается, чтобы подхватить изменившиеся лимиты
+        cursor.execute("DROP TRIGGER IF EXISTS trim_history")
+        cursor.execute(f"""
+            CREATE TRIGGER trim_history AFTER INSERT ON message_history
+            BEGIN
+                DELETE FROM message_history
+                WHERE user_id = NEW.user_id
+                  AND timestamp < datetime('now', '-{HISTORY_KEEP_DAYS} days')
+                  AND id <= (
+                    SELECT id FROM message_history
+                    WHERE user_id = NEW.user_id
+                    ORDER BY id DESC
+                    LIMIT 1 OFFSET {HISTORY_KEEP_MESSAGES}
+                  );
+            END
+        """)
         
         conn.commit()
         conn.close()
     
-    def add_user(self, user_id: int, username: str, full_name: str):
-        """Добавление нового пользователя"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute("""
-            INSERT INTO users (user_id, username, full_name, last_request_date) 
-            VALUES (?, ?, ?, ?)
-            ON CONFLICT(user_id) DO UPDATE SET
-                username = excluded.username,
-                full_name = excluded.full_name,
-                last_activity = CURRENT_TIMESTAMP
-        """, (user_id, username, full_name, date.today()))
-        
-        conn.commit()
-        conn.close()
-
-    def check_user(self, user_id: int) -> bool:
-        """Проверка, существует ли пользователь в базе по user_id"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute("""
-            SELECT 1
-            FROM users
-            WHERE user_id = ?
-            LIMIT 1
-        """, (user_id,))
-        
-        result = cursor.fetchone()
-        conn.close()
+    def add_user(self, user_id: int, username: str, full_name: str) -> bool:
+        """Добавление пользователя или обновление его имени. Возвращает True для нового пользователя"""
+        with self._connection() as conn:
+            cursor = conn.cursor()
+            
+            cursor.execute("""
+                INSERT OR IGNORE INTO users (user_id, username, full_name, last_request_date)
+                VALUES (?, ?, ?, ?)
+            """, (user_id, username, full_name, date.today()))
+            created = cursor.rowcount == 1
+            
+            if not created:
+                # Пишем только если имя изменилось. last_activity не трогаем - по ней считается пауза между запросами
+                cursor.execute("""
+                    UPDATE users
+                    SET username = ?, full_name = ?
+                    WHERE user_id = ? AND (username IS NOT ? OR full_name IS NOT ?)
+                """, (username, full_name, user_id, username, full_name))
         
-        return bool(result)
+        return created
 
-    
     def add_message(self, user_id: int, role: str, content: str):
         """Добавление сообщения в историю"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute("""
-            INSERT INTO message_history (user_id, role, content)
-            VALUES (?, ?, ?)
-        """, (user_id, role, content))
-        
-        conn.commit()
-        conn.close()
+        with self._connection() as conn:
+            cursor = conn.cursor()
+            
+            cursor.execute(_SQL_ADD_MESSAGE, (user_id, role, content))
     
     def get_history(self, user_id: int, limit: int = 20) -> List[Dict]:
         """Получение истории сообщений"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute("""
-            SELECT role, content, timestamp
-            FROM message_history
-            WHERE user_id = ?
-            ORDER BY timestamp DESC
-            LIMIT ?
-        """, (user_id, limit))
+        with self._connection() as conn:
+            cursor = conn.cursor()
+            
+            history = self._fetch_history(cursor, user_id, limit)
         
-        messages = cursor.fetchall()
-        conn.close()
+        return history
+
+    def _fetch_history(self, cursor, user_id: int, limit: int) -> List[Dict]:
+        """Последние limit сообщений пользователя в хронологическом порядке"""
+        cursor.execute(_SQL_HISTORY, (user_id, limit))
         
         return [
             {"role": msg['role'], "content": msg['content'], "timestamp": msg['timestamp']}
-            for msg in reversed(messages)
+            for msg in cursor
         ]
     
     def clear_history(self, user_id: int):
         """Очистка истории пользователя"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute("DELETE FROM message_history WHERE user_id = ?", (user_id,))
-        conn.commit()
-        conn.close()
+        with self._connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("DELETE FROM message_history WHERE user_id = ?", (user_id,))
     
     def get_remaining_requests(self, user_id: int) -> int:
         """Получение оставшихся запросов на сегодня"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute("""
-            SELECT today_requests, last_request_date
-            FROM users
-            WHERE user_id = ?
-        """, (user_id,))
-        
-        result = cursor.fetchone()
-        conn.close()
+        with self._connection() as conn:
+            cursor = conn.cursor()
+            
+            cursor.execute(_SQL_REMAINING, (datetime.now(), user_id))
+            
+            result = cursor.fetchone()
         
         if not result:
             return FREE_DAILY_LIMIT
         
-        has_active_subscription = self.get_subscription_info(user_id)['is_active']
-        
-        today = date.today()
-        last_date = datetime.strptime(result['last_request_date'], '%Y-%m-%d').date() if result['last_request_date'] else None
+        return self._calc_remaining(result['today_requests'], result['last_request_date'], result['sub_end'] is not None)
+
+    def _calc_remaining(self, today_requests: int, last_request_date: Optional[date], has_active_subscription: bool) -> int:
+        """Остаток запросов на сегодня по счетчику и статусу подписки"""
         daily_limit = PREMIUM_DAILY_LIMIT if has_active_subscription else FREE_DAILY_LIMIT
-        if last_date != today:
+        if last_request_date != date.today():
             return daily_limit
         
-        return max(0, daily_limit - result['today_requests'])
+        return max(0, daily_limit - today_requests)
     
     def update_stats(self, user_id: int, input_tokens: int, output_tokens: int, cost: float):
         """Обновление статистики пользователя"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
+        with self._connection() as conn:
+            cursor = conn.cursor()
+            
+            self._update_stats(cursor, user_id, input_tokens, output_tokens, cost)
+
+    def _update_stats(self, cursor, user_id: int, input_tokens: int, output_tokens: int, cost: float):
+        """Обновление счетчиков пользователя в рамках переданного курсора"""
         today = date.today()
         
-        # Проверяем, нужно ли сбросить счетчик
-        cursor.execute("SELECT last_request_date FROM users WHERE user_id = ?", (user_id,))
-        result = cursor.fetchone()
-        
-        if result:
-            last_date = datetime.strptime(result['last_request_date'], '%Y-%m-%d').date() if result['last_request_date'] else None
-            if last_date != today:
-                cursor.execute("""
-                    UPDATE users
-                    SET today_requests = 1,
-                        last_request_date = ?
-                    WHERE user_id = ?
-                """, (today, user_id))
-            else:
-                cursor.execute("""
-                    UPDATE users
-                    SET today_requests = today_requests + 1
-                    WHERE user_id = ?
-                """, (user_id,))
-        
-        cursor.execute("""
-            UPDATE users
-            SET message_count = message_count + 1,
-                total_input_tokens = total_input_tokens + ?,
-                total_output_tokens = total_output_tokens + ?,
-                total_cost = total_cost + ?,
-                last_activity = CURRENT_TIMESTAMP
-            WHERE user_id = ?
-        """, (input_tokens, output_tokens, cost, user_id))
-        
-        conn.commit()
-        conn.close()
+        cursor.execute(_SQL_UPDATE_STATS, (today, today, input_tokens, output_tokens, cost, user_id))
+
+    def finalize_message(self, user_id: int, user_text: str, assistant_text: str,
+                         input_tokens: int, output_tokens: int, cost: float):
+        """Сохраняет обмен сообщениями и статистику одной транзакцией"""
+        with self.transaction() as conn:
+            cursor = conn.cursor()
+            
+            cursor.executemany(_SQL_ADD_MESSAGE, [(user_id, "user", user_text), (user_id, "assistant", assistant_text)])
+            self._update_stats(cursor, user_id, input_tokens, output_tokens, cost)
     
     def get_subscription_info(self, user_id: int) -> Dict:
         """Получение информации о подписке"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute("""
-            SELECT end_date, is_active
-            FROM subscriptions
-            WHERE user_id = ? AND is_active = 1
-            ORDER BY end_date DESC
-            LIMIT 1
-        """, (user_id,))
-        
-        result = cursor.fetchone()
-        conn.close()
+        with self._connection() as conn:
+            cursor = conn.cursor()
+            
+            cursor.execute(_SQL_ACTIVE_SUBSCRIPTION, (user_id,))
+            
+            result = cursor.fetchone()
         
-        if result:
-            end_date = datetime.strptime(result['end_date'], '%Y-%m-%d %H:%M:%S.%f')
-            if end_date > datetime.now():
-                return {
-                    'is_active': True,
-                    'expires_at': end_date.strftime('%d.%m.%Y')
-                }
-            else:
-                # Деактивируем истекшую подписку
-                conn = self.get_connection()
-                cursor = conn.cursor()
-                cursor.execute("""
-                    UPDATE subscriptions 
-                    SET is_active = 0 
-                    WHERE user_id = ? AND end_date < ?
-                """, (user_id, datetime.now()))
-                conn.commit()
-                conn.close()
+        return self._check_subscription(result['end_date'] if result else None)
+
+    def _check_subscription(self, end_date: Optional[datetime]) -> Dict:
+        """Статус подписки по дате окончания"""
+        if end_date and end_date > datetime.now():
+            return {
+                'is_active': True,
+                'expires_at': end_date.strftime('%d.%m.%Y')
+            }
         
         return {'is_active': False, 'expires_at': None}
     
+    def sweep_expired_subscriptions(self) -> int:
+        """Деактивирует истекшие подписки. Возвращает число деактивированных"""
+        with self._connection() as conn:
+            cursor = conn.cursor()
+            
+            cursor.execute("""
+                UPDATE subscriptions 
+                SET is_active = 0 
+                WHERE is_active = 1 AND end_date < ?
+            """, (datetime.now(),))
+            
+            return cursor.rowcount
+
+    def get_chat_context(self, user_id: int, history_limit: int = 20) -> ChatContext:
+        """Получение подписки, лимитов, активности и истории за одно подключение"""
+        with self._connection() as conn:
+            cursor = conn.cursor()
+            
+            cursor.execute(_SQL_CHAT_CONTEXT, (user_id,))
+            
+            result = cursor.fetchone()
+            
+            if not result:
+                return ChatContext(
+                    exists=False,
+                    subscription={'is_active': False, 'expires_at': None},
+                    remaining=FREE_DAILY_LIMIT,
+                    last_activity_ts=None,
+                    history=[]
+                )
+            
+            subscription = self._check_subscription(result['end_date'])
+            history = self._fetch_history(cursor, user_id, history_limit)
+        
+        return ChatContext(
+            exists=True,
+            subscription=subscription,
+            remaining=self._calc_remaining(result['today_requests'], result['last_request_date'], subscription['is_active']),
+            last_activity_ts=result['last_activity_ts'],
+            history=history
+        )
+    
     def add_subscription(self, user_id: int, days: int, price: int):
         """Добавление подписки"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
-        # Определяем период
-        period = ""
-        if days == 7:
-            period = "week"
-        elif days == 30:
-            period = "month"
-        elif days == 60:
-            period = "2 month"
-        
-        start_date = datetime.now()
-        end_date = start_date + timedelta(days=days)
-        
-        cursor.execute("""
-            INSERT INTO subscriptions (user_id, start_date, end_date, period, price)
-            VALUES (?, ?, ?, ?, ?)
-        """, (user_id, start_date, end_date, period, price))
-        
-        conn.commit()
-        conn.close()
+        with self._connection() as conn:
+            cursor = conn.cursor()
+            
+            # Определяем период
+            period = ""
+            if days == 7:
+                period = "week"
+            elif days == 30:
+                period = "month"
+            elif days == 60:
+                period = "2 month"
+            
+            start_date = datetime.now()
+            end_date = start_date + timedelta(days=days)
+            
+            cursor.execute("""
+                INSERT INTO subscriptions (user_id, start_date, end_date, period, price)
+                VALUES (?, ?, ?, ?, ?)
+            """, (user_id, start_date, end_date, period, price))
     
     def get_user_stats(self, user_id: int) -> Optional[Dict]:
         """Получение подробной статистики пользователя"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute("""
-            SELECT 
-                u.username,
-                u.full_name,
-                u.registration_date,
-                u.last_activity,
-                u.message_count,
-                u.today_requests,
-                u.total_input_tokens,
-                u.total_output_tokens,
-                u.total_cost
-            FROM users u
-            WHERE u.user_id = ?
-        """, (user_id,))
-        
-        result = cursor.fetchone()
-        conn.close()
+        with self._connection() as conn:
+            cursor = conn.cursor()
+            
+            cursor.execute("""
+                SELECT 
+                    u.username,
+                    u.full_name,
+                    u.registration_date,
+                    u.last_activity,
+                    u.message_count,
+                    u.today_requests,
+                    u.total_input_tokens,
+                    u.total_output_tokens,
+                    u.total_cost
+                FROM users u
+                WHERE u.user_id = ?
+            """, (user_id,))
+            
+            result = cursor.fetchone()
 
         if result:
-            reg_date = datetime.strptime(result['registration_date'], '%Y-%m-%d %H:%M:%S')
-            last_act = datetime.strptime(result['last_activity'], '%Y-%m-%d %H:%M:%S')
-            
             return {
                 "username": result['username'],
                 "full_name": result['full_name'],
-                "registration_date": reg_date.strftime('%d.%m.%Y'),
-                "last_activity": last_act.strftime('%d.%m.%Y %H:%M:%S'),
+                "registration_date": result['registration_date'].strftime('%d.%m.%Y'),
+                "last_activity": result['last_activity'].strftime('%d.%m.%Y %H:%M:%S'),
                 "total_messages": result['message_count'],
                 "today_requests": result['today_requests'],
                 "total_input_tokens": result['total_input_tokens'],
@@ -324,130 +533,82 @@ class Database:
             }
         return None
     
-    def get_user_last_act(self, user_id: int) -> Optional[Dict]:
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute("""
-            SELECT 
-                u.last_activity,
-                CURRENT_TIMESTAMP AS current_time
-            FROM users u
-            WHERE u.user_id = ?
-        """, (user_id,))
-        
-        result = cursor.fetchone()
-        conn.close()
-
-        if result:
-            last_act = result['last_activity']
-            current_time = result['current_time']
-            return {
-                "last_activity": last_act,
-                "current_time": current_time
-            }
-        return None
-    
     def get_general_stats(self) -> Dict:
         """Получение общей статистики"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
-        # Всего пользователей
-        cursor.execute("SELECT COUNT(*) as cnt FROM users")
-        total_users = cursor.fetchone()['cnt']
-        
-        # Активные сегодня
-        today = date.today()
-        cursor.execute("""
-            SELECT COUNT(*) as cnt FROM users 
-            WHERE DATE(last_activity) = ?
-        """, (today,))
-        active_today = cursor.fetchone()['cnt']
-        
-        # Новые за неделю
-        week_ago = datetime.now() - timedelta(days=7)
-        cursor.execute("""
-            SELECT COUNT(*) as cnt FROM users 
-            WHERE registration_date >= ?
-        """, (week_ago,))
-        new_week = cursor.fetchone()['cnt']
-        
-        # С активной подпиской
-        cursor.execute("""
-            SELECT COUNT(DISTINCT user_id) as cnt 
-            FROM subscriptions 
-            WHERE is_active = 1 AND end_date > ?
-        """, (datetime.now(),))
-        with_subscription = cursor.fetchone()['cnt']
-        
-        # Всего сообщений
-        cursor.execute("SELECT SUM(message_count) as cnt FROM users")
-        total_messages = cursor.fetchone()['cnt'] or 0
-        
-        # Сообщений сегодня
-        cursor.execute("""
-            SELECT COUNT(*) as cnt FROM message_history 
-            WHERE DATE(timestamp) = ?
-        """, (today,))
-        today_messages = cursor.fetchone()['cnt']
-        
-        # Токены и затраты
-        cursor.execute("""
-            SELECT 
-                SUM(total_input_tokens) as input_tokens,
-                SUM(total_output_tokens) as output_tokens,
-                SUM(total_cost) as cost
-            FROM users
-        """)
-        tokens_data = cursor.fetchone()
-        
-        conn.close()
+        with self._connection() as conn:
+            cursor = conn.cursor()
+            
+            today = date.today()
+            week_ago = datetime.now() - timedelta(days=7)
+            
+            # Агрегаты по пользователям - за один проход по таблице, остальное - подзапросами.
+            # Сравнение с началом дня вместо DATE(...) = ? позволяет использовать индексы
+            cursor.execute("""
+                SELECT 
+                    COUNT(*) as total_users,
+                    COALESCE(SUM(last_activity >= ?), 0) as active_today,
+                    COALESCE(SUM(registration_date >= ?), 0) as new_week,
+                    COALESCE(SUM(message_count), 0) as total_messages,
+                    COALESCE(SUM(total_input_tokens), 0) as input_tokens,
+                    COALESCE(SUM(total_output_tokens), 0) as output_tokens,
+                    COALESCE(SUM(total_cost), 0.0) as cost,
+                    (
+                        SELECT COUNT(DISTINCT user_id)
+                        FROM subscriptions
+                        WHERE is_active = 1 AND end_date > ?
+                    ) as with_subscription,
+                    (
+                        SELECT COUNT(*)
+                        FROM message_history
+                        WHERE timestamp >= ?
+                    ) as today_messages
+                FROM users
+            """, (today, week_ago, datetime.now(), today))
+            stats = cursor.fetchone()
         
         return {
-            "total_users": total_users,
-            "active_today": active_today,
-            "new_week": new_week,
-            "with_subscription": with_subscription,
-            "total_messages": total_messages,
-            "today_messages": today_messages,
-            "total_input_tokens": tokens_data['input_tokens'] or 0,
-            "total_output_tokens": tokens_data['output_tokens'] or 0,
-            "total_cost": tokens_data['cost'] or 0.0
+            "total_users": stats['total_users'],
+            "active_today": stats['active_today'],
+            "new_week": stats['new_week'],
+            "with_subscription": stats['with_subscription'],
+            "total_messages": stats['total_messages'],
+            "today_messages": stats['today_messages'],
+            "total_input_tokens": stats['input_tokens'],
+            "total_output_tokens": stats['output_tokens'],
+            "total_cost": stats['cost']
         }
     
     def get_recent_users(self, limit: int = 10) -> List[Dict]:
         """Получение последних пользователей"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute("""
-            SELECT 
-                u.user_id,
-                u.username,
-                u.full_name,
-                u.registration_date,
-                u.message_count,
-                CASE WHEN s.user_id IS NOT NULL THEN 1 ELSE 0 END as has_subscription
-            FROM users u
-            LEFT JOIN (
-                SELECT DISTINCT user_id 
-                FROM subscriptions 
-                WHERE is_active = 1 AND end_date > ?
-            ) s ON u.user_id = s.user_id
-            ORDER BY u.registration_date DESC
-            LIMIT ?
-        """, (datetime.now(), limit))
-        
-        results = cursor.fetchall()
-        conn.close()
+        with self._connection() as conn:
+            cursor = conn.cursor()
+            
+            cursor.execute("""
+                SELECT 
+                    u.user_id,
+                    u.username,
+                    u.full_name,
+                    u.registration_date,
+                    u.message_count,
+                    CASE WHEN s.user_id IS NOT NULL THEN 1 ELSE 0 END as has_subscription
+                FROM users u
+                LEFT JOIN (
+                    SELECT DISTINCT user_id 
+                    FROM subscriptions 
+                    WHERE is_active = 1 AND end_date > ?
+                ) s ON u.user_id = s.user_id
+                ORDER BY u.registration_date DESC
+                LIMIT ?
+            """, (datetime.now(), limit))
+            
+            results = cursor.fetchall()
         
         return [
             {
                 "user_id": row['user_id'],
                 "username": row['username'] or "Нет username",
                 "full_name": row['full_name'],
-                "registration_date": datetime.strptime(row['registration_date'], '%Y-%m-%d %H:%M:%S').strftime('%d.%m.%Y'),
+                "registration_date": row['registration_date'].strftime('%d.%m.%Y'),
                 "message_count": row['message_count'],
                 "has_subscription": bool(row['has_subscription'])
             }
@@ -456,66 +617,65 @@ class Database:
     
     def get_finance_stats(self) -> Dict:
         """Получение финансовой статистики"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
-        # Доход от подписок
-        cursor.execute("SELECT SUM(price) as total FROM subscriptions")
-        total_revenue = cursor.fetchone()['total'] or 0
-        
-        # За месяц
-        month_ago = datetime.now() - timedelta(days=30)
-        cursor.execute("""
-            SELECT SUM(price) as total 
-            FROM subscriptions 
-            WHERE start_date >= ?
-        """, (month_ago,))
-        month_revenue = cursor.fetchone()['total'] or 0
-        
-        # За неделю
-        week_ago = datetime.now() - timedelta(days=7)
-        cursor.execute("""
-            SELECT SUM(price) as total 
-            FROM subscriptions 
-            WHERE start_date >= ?
-        """, (week_ago,))
-        week_revenue = cursor.fetchone()['total'] or 0
-        
-        # Расходы на API
-        cursor.execute("SELECT SUM(total_cost) as cost FROM users")
-        total_api_cost = cursor.fetchone()['cost'] or 0.0
-        
-        # За месяц (примерная оценка по сообщениям за последний месяц)
-        cursor.execute("""
-            SELECT SUM(u.total_cost) / u.message_count * COUNT(m.id) as cost
-            FROM users u
-            JOIN message_history m ON u.user_id = m.user_id
-            WHERE m.timestamp >= ?
-        """, (month_ago,))
-        month_api_cost = cursor.fetchone()['cost'] or 0.0
-        
-        # За неделю
-        cursor.execute("""
-            SELECT SUM(u.total_cost) / u.message_count * COUNT(m.id) as cost
-            FROM users u
-            JOIN message_history m ON u.user_id = m.user_id
-            WHERE m.timestamp >= ?
-        """, (week_ago,))
-        week_api_cost = cursor.fetchone()['cost'] or 0.0
-        
-        # Активные подписки
-        cursor.execute("""
-            SELECT COUNT(DISTINCT user_id) as cnt 
-            FROM subscriptions 
-            WHERE is_active = 1 AND end_date > ?
-        """, (datetime.now(),))
-        active_subscriptions = cursor.fetchone()['cnt']
-        
-        # Всего продано
-        cursor.execute("SELECT COUNT(*) as cnt FROM subscriptions")
-        total_subscriptions = cursor.fetchone()['cnt']
-        
-        conn.close()
+        with self._connection() as conn:
+            cursor = conn.cursor()
+            
+            # Доход от подписок
+            cursor.execute("SELECT SUM(price) as total FROM subscriptions")
+            total_revenue = cursor.fetchone()['total'] or 0
+            
+            # За месяц
+            month_ago = datetime.now() - timedelta(days=30)
+            cursor.execute("""
+                SELECT SUM(price) as total 
+                FROM subscriptions 
+                WHERE start_date >= ?
+            """, (month_ago,))
+            month_revenue = cursor.fetchone()['total'] or 0
+            
+            # За неделю
+            week_ago = datetime.now() - timedelta(days=7)
+            cursor.execute("""
+                SELECT SUM(price) as total 
+                FROM subscriptions 
+                WHERE start_date >= ?
+            """, (week_ago,))
+            week_revenue = cursor.fetchone()['total'] or 0
+            
+            # Расходы на API
+            cursor.execute("SELECT SUM(total_cost) as cost FROM users")
+            total_api_cost = cursor.fetchone()['cost'] or 0.0
+            
+            # За месяц и за неделю (оценка): средняя стоимость запроса пользователя,
+            # умноженная на число его запросов за период
+            cursor.execute("""
+                SELECT 
+                    COALESCE(SUM(u.total_cost * p.month_count / u.message_count), 0.0) as month_cost,
+                    COALESCE(SUM(u.total_cost * p.week_count / u.message_count), 0.0) as week_cost
+                FROM (
+                    SELECT user_id, COUNT(*) as month_count, SUM(timestamp >= ?) as week_count
+                    FROM message_history
+                    WHERE role = 'user' AND timestamp >= ?
+                    GROUP BY user_id
+                ) p
+                JOIN users u ON u.user_id = p.user_id
+                WHERE u.message_count > 0
+            """, (week_ago, month_ago))
+            period_costs = cursor.fetchone()
+            month_api_cost = period_costs['month_cost']
+            week_api_cost = period_costs['week_cost']
+            
+            # Активные подписки
+            cursor.execute("""
+                SELECT COUNT(DISTINCT user_id) as cnt 
+                FROM subscriptions 
+                WHERE is_active = 1 AND end_date > ?
+            """, (datetime.now(),))
+            active_subscriptions = cursor.fetchone()['cnt']
+            
+            # Всего продано
+            cursor.execute("SELECT COUNT(*) as cnt FROM subscriptions")
+            total_subscriptions = cursor.fetchone()['cnt']
         
         return {
             "total_revenue": total_revenue,
@@ -530,18 +690,17 @@ class Database:
     
     def get_top_users(self, limit: int = 10) -> List[Dict]:
         """Получение топа пользователей"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute("""
-            SELECT user_id, username, full_name, message_count, total_cost
-            FROM users
-            ORDER BY message_count DESC
-            LIMIT ?
-        """, (limit,))
-        
-        results = cursor.fetchall()
-        conn.close()
+        with self._connection() as conn:
+            cursor = conn.cursor()
+            
+            cursor.execute("""
+                SELECT user_id, username, full_name, message_count, total_cost
+                FROM users
+                ORDER BY message_count DESC
+                LIMIT ?
+            """, (limit,))
+            
+            results = cursor.fetchall()
         
         return [
             {
@@ -554,13 +713,41 @@ class Database:
             for row in results
         ]
     
-    def get_all_user_ids(self) -> List[int]:
-        """Получение ID всех пользователей"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute("SELECT user_id FROM users")
-        results = cursor.fetchall()
-        conn.close()
+    def get_user_ids_batch(self, after_id: int = 0, limit: int = 1000) -> List[int]:
+        """Порция ID пользователей, следующих за after_id (по возрастанию)"""
+        with self._connection() as conn:
+            cursor = conn.cursor()
+            
+            cursor.execute(
+                "SELECT user_id FROM users WHERE user_id > ? ORDER BY user_id LIMIT ?",
+                (after_id, limit)
+            )
+            results = cursor.fetchall()
         
-        return [row['user_id'] for row in results]
\ No newline at end of file
+        return [row['user_id'] for row in results]
+
+
+class AsyncDatabase:
+    """
+    Асинхронная обертка над Database: каждый метод выполняется в пуле потоков
+    через asyncio.to_thread и не блокирует цикл событий
+    """
+
+    def __init__(self, db: Database):
+        self._db = db
+
+    def __getattr__(self, name: str):
+        attr = getattr(self._db, name)
+        if not callable(attr):
+            return attr
+        # Генератор выполнял бы запросы к sqlite в цикле событий, держа подключение пула
+        if inspect.isgeneratorfunction(attr):
+            raise TypeError(f"Генератор Database.{name} нельзя вызывать через AsyncDatabase")
+
+        @functools.wraps(attr)
+        async def wrapper(*args, **kwargs):
+            return await asyncio.to_thread(attr, *args, **kwargs)
+
+        # Обертку создаем один раз на метод
+        setattr(self, name, wrapper)
+        return wrapper
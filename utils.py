@@ -1,144 +1,259 @@
 import re
+import time
+from collections import OrderedDict
+from functools import lru_cache
 from html import escape
+from typing import Iterator
+
+# Вся разметка ищется одним проходом: альтернативы проверяются слева направо,
+# поэтому код-блоки и таблицы "поглощают" свое содержимое и внутри них
+# остальные правила не срабатывают. Имя группы определяет тип токена
+_MARKDOWN_COMMENT_RULE = r'(?P<comment>/\*[\s\S]*?\*/)'     # C-комментарий /* ... */
+
+_MARKDOWN_BLOCK_RULES = (
+    r'```(?:\w+)?\n(?P<code_block>[\s\S]*?)```',              # многострочный код-блок
+    r'^(?P<table>\|.+\|\n\|[\s:|\-]+\|\n(?:\|.+\|\n?)*)',     # таблица
+)
+
+_MARKDOWN_INLINE_RULES = (
+    r'`(?P<code>[^`]+)`',                                     # инлайн код
+    r'\*\*(?P<bold1>[^*]+)\*\*',                              # жирный
+    r'__(?P<bold2>[^_]+)__',                                  # жирный
+    r'\*(?P<italic1>[^*]+)\*',                                # курсив
+    r'_(?P<italic2>[^_]+)_',                                  # курсив
+    r'~~(?P<strike>[^~]+)~~',                                 # зачёркнутый
+    r'\[(?P<link_text>[^\]]+)\]\((?P<link_url>[^)]+)\)',       # ссылка
+    r'\|\|(?P<spoiler>.+?)\|\|',                              # спойлер
+)
+
+_RE_MARKDOWN = re.compile(
+    '|'.join((_MARKDOWN_COMMENT_RULE, *_MARKDOWN_BLOCK_RULES, *_MARKDOWN_INLINE_RULES)),
+    re.MULTILINE
+)
+
+# Большинство ответов - проза без код-блоков и таблиц: для них хватает короткой
+# альтернации, которую движок перебирает заметно быстрее
+_RE_MARKDOWN_INLINE = re.compile(
+    '|'.join((_MARKDOWN_COMMENT_RULE, *_MARKDOWN_INLINE_RULES)),
+    re.MULTILINE
+)
+
+# Символы, без которых в тексте нет никакой разметки
+_RE_MARKDOWN_CHARS = re.compile(r'[*_`~|\[]')
+
+# Группы, содержимое которых тоже может быть размечено, и их теги
+_NESTED_TAGS = {
+    'bold1': 'b',
+    'bold2': 'b',
+    'italic1': 'i',
+    'italic2': 'i',
+    'strike': 's',
+    'spoiler': 'tg-spoiler',
+}
+
+
+# Готовые <pre>-блоки в HTML и границы предложений/абзацев для smart_split_message
+_RE_PRE_BLOCK = re.compile(r'<pre>([\s\S]*?)</pre>')
+_RE_SENTENCE = re.compile(r'[.!?]+\s+|\n\n+')
+# HTML-теги, которые выдает markdown_to_html: группа 1 - "/" у закрывающего, 2 - имя
+_RE_TAG = re.compile(r'<(/?)([a-z][a-z-]*)[^>]*>')
+
+MARKDOWN_CACHE_SIZE = 512
+MARKDOWN_CACHE_MAX_LENGTH = 4096
+
+# Ячейки таблиц и инлайн код короткие и часто повторяются ("-", числа, заголовки)
+_escape_short = lru_cache(maxsize=2048)(escape)
+
+
+def _table_to_pre(table_text: str, parts: list[str]):
+    """
+    Таблица Markdown -> моноширинный текст для Telegram, дописывается в parts
+    """
+    # Каждую строку и ячейку обрезаем один раз
+    lines = [line for line in map(str.strip, table_text.split('\n')) if line]
+    
+    if len(lines) < 2:
+        parts.append(escape(table_text))
+        return
+    
+    # Вторая строка - разделитель (---|---|---), ее пропускаем
+    del lines[1]
+    rows = []
+    for line in lines:
+        # Пустые ячейки по краям (из-за | в начале/конце) отбрасываем
+        cells = [cell for cell in map(str.strip, line.split('|')) if cell]
+        if cells:
+            rows.append(cells)
+    
+    if not rows:
+        parts.append(escape(table_text))
+        return
+    
+    # Дополняем короткие строки пустыми ячейками, чтобы zip не обрезал колонки
+    num_cols = max(map(len, rows))
+    rows = [row + [''] * (num_cols - len(row)) for row in rows]
+    
+    # Максимальная ширина каждой колонки
+    col_widths = [max(map(len, col)) for col in zip(*rows)]
+    
+    # Выровненные строки пишем сразу в parts, после заголовка - разделитель
+    header, *body = rows
+    parts.append('<pre>\n')
+    parts.append(' | '.join(_escape_short(cell.ljust(width)) for cell, width in zip(header, col_widths)))
+    parts.append('\n')
+    parts.append('-+-'.join('-' * width for width in col_widths))
+    for row in body:
+        parts.append('\n')
+        parts.append(' | '.join(_escape_short(cell.ljust(width)) for cell, width in zip(row, col_widths)))
+    parts.append('\n</pre>')
+
 
 def markdown_to_html(text: str) -> str:
     """
     Конвертируем Markdown и Gemini-ответ в безопасный HTML для Telegram
     """
-   
-    # 1. Удаляем C-стиль комментарии /* ... */
-    text = re.sub(r'/\*[\s\S]*?\*/', '', text, flags=re.DOTALL)
-    
-    # 2. Многострочные код-блоки
-    def code_block_replacer(match):
-        content = escape(match.group(1))
-        return f"<pre>{content}</pre>"
-   
-    text = re.sub(r'```(?:\w+)?\n([\s\S]*?)```', code_block_replacer, text, flags=re.DOTALL)
-    
-    # 3. Таблицы - конвертируем в моноширинный текст для Telegram
-    def table_replacer(match):
-        table_text = match.group(0)
-        lines = [line.strip() for line in table_text.strip().split('\n') if line.strip()]
-        
-        if len(lines) < 2:
-            return table_text
-        
-        # Парсим все строки
-        rows = []
-        for i, line in enumerate(lines):
-            if i == 1:  # Пропускаем разделительную строку (---|---|---)
-                continue
-            cells = [cell.strip() for cell in line.split('|')]
-            # Убираем пустые ячейки по краям (из-за | в начале/конце)
-            cells = [c for c in cells if c]
-            if cells:
-                rows.append(cells)
-        
-        if not rows:
-            return table_text
-        
-        # Вычисляем максимальную ширину для каждой колонки
-        num_cols = len(rows[0])
-        col_widths = [0] * num_cols
-        
-        for row in rows:
-            for i, cell in enumerate(row):
-                if i < num_cols:
-                    col_widths[i] = max(col_widths[i], len(cell))
-        
-        # Формируем выровненную таблицу
-        result = '<pre>\n'
-        
-        for idx, row in enumerate(rows):
-            line_parts = []
-            for i, cell in enumerate(row):
-                if i < num_cols:
-                    # Выравниваем по левому краю с отступом
-                    line_parts.append(cell.ljust(col_widths[i]))
-            result += ' | '.join(line_parts) + '\n'
-            
-            # После заголовка добавляем разделитель
-            if idx == 0:
-                separator_parts = ['-' * width for width in col_widths]
-                result += '-+-'.join(separator_parts) + '\n'
-        
-        result += '</pre>'
-        return result
+    # Обычный текст без разметки достаточно экранировать
+    if not _RE_MARKDOWN_CHARS.search(text):
+        return escape(text)
     
-    # Ищем таблицы (заголовок | разделитель | строки)
-    text = re.sub(
-        r'(?:^|\n)(\|.+\|\n\|[\s:|\-]+\|\n(?:\|.+\|\n?)*)',
-        table_replacer,
-        text,
-        flags=re.MULTILINE
-    )
+    # Длинные уникальные ответы не кэшируем, чтобы не держать их в памяти
+    if len(text) > MARKDOWN_CACHE_MAX_LENGTH:
+        return _convert_markdown(text)
+    return _convert_markdown_cached(text)
+
+
+def _convert_markdown(text: str) -> str:
+    """
+    Конвертация без кэша
+    """
+    # Код-блоку нужен ```, а у таблицы вторая строка всегда начинается с "|"
+    if '```' in text or '\n|' in text:
+        pattern = _RE_MARKDOWN
+    else:
+        pattern = _RE_MARKDOWN_INLINE
     
-    # 4. Инлайн код
-    def inline_code_replacer(match):
-        return f'<code>{escape(match.group(1))}</code>'
-       
-    text = re.sub(r'`([^`]+)`', inline_code_replacer, text)
+    parts: list[str] = []
+    _render_markdown(text, parts, pattern)
+    return ''.join(parts)
+
+
+# Повторяющиеся короткие ответы конвертируются один раз
+_convert_markdown_cached = lru_cache(maxsize=MARKDOWN_CACHE_SIZE)(_convert_markdown)
+
+
+def _render_markdown(text: str, parts: list[str], pattern: re.Pattern):
+    """
+    Дописывает HTML-фрагменты в общий список parts; вложенная разметка пишется туда же.
+    pattern - _RE_MARKDOWN или _RE_MARKDOWN_INLINE, если блоков в тексте точно нет
+    """
+    pos = 0
     
-    # 5. Жирный
-    text = re.sub(r'\*\*([^*]+)\*\*', r'<b>\1</b>', text)
-    text = re.sub(r'__([^_]+)__', r'<b>\1</b>', text)
+    for match in pattern.finditer(text):
+        # Текст между токенами выводим как есть, экранируя HTML
+        if match.start() > pos:
+            parts.append(escape(text[pos:match.start()]))
+        pos = match.end()
+        
+        kind = match.lastgroup
+        if kind == 'comment':
+            # Комментарии удаляем
+            continue
+        elif kind == 'code_block':
+            parts.append("<pre>")
+            parts.append(escape(match.group('code_block')))
+            parts.append("</pre>")
+        elif kind == 'table':
+            _table_to_pre(match.group('table'), parts)
+        elif kind == 'code':
+            parts.append("<code>")
+            parts.append(_escape_short(match.group('code')))
+            parts.append("</code>")
+        elif kind == 'link_url':
+            parts.append(f'<a href="{escape(match.group("link_url"))}">')
+            parts.append(escape(match.group('link_text')))
+            parts.append("</a>")
+        else:
+            tag = _NESTED_TAGS[kind]
+            parts.append(f"<{tag}>")
+            _render_markdown(match.group(kind), parts, pattern)
+            parts.append(f"</{tag}>")
     
-    # 6. Курсив
-    text = re.sub(r'\*([^*]+)\*', r'<i>\1</i>', text)
-    text = re.sub(r'_([^_]+)_', r'<i>\1</i>', text)
+    if pos < len(text):
+        parts.append(escape(text[pos:]))
+
+
+def _balance_tags(part: str, open_tags: list[tuple[str, str]]) -> str:
+    """
+    Делает часть сообщения валидным HTML: заново открывает теги, оставшиеся открытыми
+    с прошлой части, и закрывает те, что не закрылись в этой.
+    open_tags - стек (имя, открывающий тег), переходящий от части к части
+    """
+    prefix = ''.join(tag for _, tag in open_tags)
     
-    # 7. Зачёркнутый
-    text = re.sub(r'~~([^~]+)~~', r'<s>\1</s>', text)
+    # Каждая часть сканируется один раз, так что весь текст проходится за один проход
+    for match in _RE_TAG.finditer(part):
+        if not match.group(1):
+            open_tags.append((match.group(2), match.group(0)))
+        elif open_tags and open_tags[-1][0] == match.group(2):
+            open_tags.pop()
     
-    # 8. Ссылки
-    def link_replacer(match):
-        text_content = escape(match.group(1))
-        url = escape(match.group(2))
-        return f'<a href="{url}">{text_content}</a>'
-       
-    text = re.sub(r'\[([^\]]+)\]\(([^)]+)\)', link_replacer, text)
+    suffix = ''.join(f'</{name}>' for name, _ in reversed(open_tags))
+    return prefix + part + suffix
+
+
+def _iter_sentences(text: str) -> Iterator[str]:
+    """
+    Предложения и абзацы текста по очереди, каждый вместе со своим разделителем
+    """
+    last = 0
+    for match in _RE_SENTENCE.finditer(text):
+        yield text[last:match.end()]
+        last = match.end()
+    if last < len(text):
+        yield text[last:]
+
+
+def _iter_pre_chunks(block: str, size: int) -> Iterator[str]:
+    """
+    Режет слишком длинный <pre>-блок на куски не длиннее size, каждый в своем <pre>.
+    Режем по переводу строки, а если его нет - хотя бы не посреди HTML-сущности
+    """
+    content = block[len('<pre>'):-len('</pre>')]
+    start = 0
     
-    # 9. Спойлеры
-    text = re.sub(r'\|\|(.+?)\|\|', r'<tg-spoiler>\1</tg-spoiler>', text)
-   
-    return text
+    while start < len(content):
+        end = start + size
+        if end < len(content):
+            newline = content.rfind('\n', start, end)
+            amp = content.rfind('&', start, end)
+            if newline != -1 and newline > start:
+                end = newline + 1
+            elif amp > start and content.find(';', amp, end) == -1:
+                end = amp
+        yield '<pre>' + content[start:end] + '</pre>'
+        start = end
 
 
-def smart_split_message(text: str, max_length: int = 4096) -> list[str]:
+def smart_split_message(text: str, max_length: int = 4096) -> Iterator[str]:
     """
-    Умное разделение сообщения с учетом HTML-тегов, таблиц и целостности текста
+    Умное разделение сообщения с учетом HTML-тегов, таблиц и целостности текста.
+    Части отдаются по одной, по мере готовности
     """
     if len(text) <= max_length:
-        return [text]
-    
-    parts = []
-    current_part = ""
+        yield text
+        return
     
     # Разбиваем текст на блоки (параграфы, таблицы, код-блоки)
     blocks = []
     
-    # Находим все таблицы и код-блоки
-    table_pattern = r'<pre>\n(?:.*?\|.*?\n)+</pre>'
-    code_pattern = r'<pre>[\s\S]*?</pre>'
-    
-    # Сохраняем позиции специальных блоков
+    # Находим все <pre>-блоки за один проход (finditer отдает их по порядку).
+    # Таблица - это <pre>, который начинается с перевода строки и содержит колонки
     special_blocks = []
     
-    for match in re.finditer(table_pattern, text, re.MULTILINE):
-        special_blocks.append((match.start(), match.end(), 'table'))
-    
-    for match in re.finditer(code_pattern, text, re.MULTILINE):
-        # Проверяем, не является ли этот блок таблицей
-        is_table = any(
-            match.start() >= start and match.end() <= end 
-            for start, end, btype in special_blocks if btype == 'table'
-        )
-        if not is_table:
-            special_blocks.append((match.start(), match.end(), 'code'))
-    
-    # Сортируем по позиции
-    special_blocks.sort(key=lambda x: x[0])
+    for match in _RE_PRE_BLOCK.finditer(text):
+        content = match.group(1)
+        block_type = 'table' if content.startswith('\n') and '|' in content else 'code'
+        special_blocks.append((match.start(), match.end(), block_type))
     
     # Разбиваем текст на блоки
     last_pos = 0
@@ -163,8 +278,25 @@ def smart_split_message(text: str, max_length: int = 4096) -> list[str]:
     if not blocks:
         blocks = [('text', text)]
     
-    # Собираем части сообщения
-    current_part = ""
+    # Собираем части сообщения: фрагменты текущей части копятся в buf и склеиваются
+    # один раз при сбросе, buf_len - ее текущая длина
+    buf: list[str] = []
+    buf_len = 0
+    # Теги, незакрытые на границе частей; переносятся в следующую часть
+    open_tags: list[tuple[str, str]] = []
+    
+    def append(piece: str):
+        nonlocal buf_len
+        buf.append(piece)
+        buf_len += len(piece)
+    
+    def flush():
+        nonlocal buf_len
+        part = ''.join(buf).strip()
+        buf.clear()
+        buf_len = 0
+        if part:
+            yield _balance_tags(part, open_tags)
     
     for block_type, block_content in blocks:
         block_len = len(block_content)
@@ -172,65 +304,87 @@ def smart_split_message(text: str, max_length: int = 4096) -> list[str]:
         # Если блок (таблица/код) слишком большой - выделяем его отдельно
         if block_type in ['table', 'code'] and block_len > max_length:
             # Сохраняем текущую часть
-            if current_part.strip():
-                parts.append(current_part.strip())
-                current_part = ""
+            yield from flush()
             
             # Разбиваем большой блок
-            for i in range(0, block_len, max_length - 100):
-                chunk = block_content[i:i + max_length - 100]
-                parts.append(chunk)
+            for chunk in _iter_pre_chunks(block_content, max_length - 100):
+                yield _balance_tags(chunk, open_tags)
             continue
         
         # Если добавление блока превысит лимит
-        if len(current_part) + block_len + 2 > max_length:
+        if buf_len + block_len + 2 > max_length:
             # Если это таблица или код - сохраняем текущую часть и начинаем новую
             if block_type in ['table', 'code']:
-                if current_part.strip():
-                    parts.append(current_part.strip())
-                current_part = block_content
+                yield from flush()
+                append(block_content)
             else:
                 # Для обычного текста - разбиваем по предложениям/параграфам
-                if current_part.strip():
-                    parts.append(current_part.strip())
-                    current_part = ""
+                yield from flush()
                 
                 # Разбиваем текстовый блок на предложения
-                sentences = re.split(r'([.!?]+\s+|\n\n+)', block_content)
-                
-                for sentence in sentences:
+                for sentence in _iter_sentences(block_content):
                     if not sentence.strip():
                         continue
                     
-                    if len(current_part) + len(sentence) + 2 <= max_length:
-                        current_part += sentence
+                    if buf_len + len(sentence) + 2 <= max_length:
+                        append(sentence)
                     else:
-                        if current_part.strip():
-                            parts.append(current_part.strip())
+                        yield from flush()
                         
                         # Если одно предложение слишком длинное
                         if len(sentence) > max_length:
                             # Разбиваем по словам
-                            words = sentence.split()
-                            current_part = ""
-                            
-                            for word in words:
-                                if len(current_part) + len(word) + 1 <= max_length:
-                                    current_part += word + " "
-                                else:
-                                    if current_part.strip():
-                                        parts.append(current_part.strip())
-                                    current_part = word + " "
+                            for word in sentence.split():
+                                if buf_len + len(word) + 1 > max_length:
+                                    yield from flush()
+                                append(word + " ")
                         else:
-                            current_part = sentence
+                            append(sentence)
         else:
             # Добавляем блок к текущей части
-            if current_part and not current_part.endswith('\n\n'):
-                current_part += "\n\n"
-            current_part += block_content
+            if buf and not buf[-1].endswith('\n\n'):
+                append("\n\n")
+            append(block_content)
     
     # Добавляем последнюю часть
-    if current_part.strip():
-        parts.append(current_part.strip())
-    
-    return parts
\ No newline at end of file
+    yield from flush()
+
+class TTLCache:
+    """
+    Небольшой LRU-кэш с временем жизни записей (в секундах)
+    """
+
+    def __init__(self, ttl: float, maxsize: int = 10_000):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._data: OrderedDict = OrderedDict()
+
+    def get(self, key, default=None):
+        item = self._data.get(key)
+        if item is None:
+            return default
+
+        expires_at, value = item
+        if time.monotonic() >= expires_at:
+            del self._data[key]
+            return default
+
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key, value):
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        # Вытесняем самые старые записи при превышении размера
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        item = self._data.pop(key, None)
+        return item[1] if item else default
+
+    def clear(self):
+        self._data.clear()
+
+    def __len__(self):
+        return len(self._data)